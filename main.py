@@ -1,15 +1,29 @@
-import os, json, time
+import os, json, time, threading, asyncio, logging, gzip, functools
+from collections import deque
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone
-from typing import Optional, Dict, Any, List
+from email.utils import parsedate_to_datetime
+from types import MappingProxyType
+from typing import Optional, Dict, Any, List, AsyncIterator, Mapping, Deque, Tuple
 
-import requests
+import httpx
+import orjson
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Request, Query
+from fastapi import FastAPI, HTTPException, Request, Query, BackgroundTasks
+from fastapi.concurrency import run_in_threadpool
 from supabase import create_client, Client
 
-app = FastAPI()
 load_dotenv()
 
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    format="%(asctime)s %(levelname)s %(name)s %(message)s",
+)
+logger = logging.getLogger(__name__)
+# httpx/httpcore loguean cada petición a INFO (incluida la URL secreta del webhook de n8n)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("httpcore").setLevel(logging.WARNING)
+
 # ========= Config =========
 N8N_URL = os.getenv("N8N_URL", "https://primary-production-eebd.up.railway.app/webhook/ddf4ff06-3b31-4bdb-a349-c2884a5402d3")
 
@@ -18,9 +32,15 @@ CLIENT_SECRET = os.getenv("TIKTOK_CLIENT_SECRET")
 
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")  # Usa Service Role Key
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+
+@functools.lru_cache(maxsize=1)
+def get_supabase() -> Client:
+    """Cliente de Supabase, creado la primera vez que se necesita (no en el arranque)."""
+    return create_client(SUPABASE_URL, SUPABASE_KEY)
 
 BASE = "https://open.tiktokapis.com/v2"
+TIKTOK_HOST = httpx.URL(BASE).host
+TIKTOK_OAUTH_PATH = "/v2/oauth/"
 
 # Campos seguros para /video/list/
 VIDEO_FIELDS: List[str] = [
@@ -34,19 +54,201 @@ VIDEO_FIELDS: List[str] = [
     "comment_count",
     "share_count",
 ]
+VIDEO_FIELDS_CSV = ",".join(VIDEO_FIELDS)
+
+# Cuerpo base de /video/list/ (solo lectura); en cada página se copia y se añade el cursor
+BASE_LIST_BODY: Mapping[str, Any] = MappingProxyType({"max_count": 20, "fields": VIDEO_FIELDS})
+
+# Paginación paralela de /video/list/: el cursor es un timestamp en ms, así que se puede
+# trocear el rango temporal. Las primeras VIDEO_LIST_SERIAL_PAGES páginas van en serie (las
+# cuentas pequeñas terminan ahí sin peticiones de más) y sirven para estimar la densidad de
+# vídeos; con ella se lanzan tramos de unas VIDEO_LIST_PAGES_PER_SLICE páginas, hasta
+# VIDEO_LIST_CONCURRENCY a la vez, hasta cubrir todo el histórico.
+# VIDEO_LIST_EPOCH_MS (lanzamiento de TikTok) es el límite inferior.
+VIDEO_LIST_EPOCH_MS = 1472688000000  # 2016-09-01 UTC
+VIDEO_LIST_SERIAL_PAGES = 3
+VIDEO_LIST_PAGES_PER_SLICE = 3
+VIDEO_LIST_CONCURRENCY = 5
+# Páginas que cada tramo puede adelantar mientras se consumen los anteriores (un tramo entero):
+# la memoria queda acotada a VIDEO_LIST_CONCURRENCY * VIDEO_LIST_PREFETCH_PAGES páginas.
+VIDEO_LIST_PREFETCH_PAGES = VIDEO_LIST_PAGES_PER_SLICE + 1
+
+# ========= Cliente HTTP compartido =========
+# Un único cliente asíncrono para TikTok y n8n: reutiliza conexiones (keep-alive,
+# HTTP/2) y no bloquea el event loop mientras esperamos a la red.
+# Se abre/cierra en el lifespan de la app.
+ASYNC_CLIENT: Optional[httpx.AsyncClient] = None
+
+# Reintentos ante 429/5xx transitorios (respetando Retry-After), para no perder un crawl largo.
+# Solo las llamadas de datos de TikTok se reintentan ante cualquier 5xx: el webhook de n8n y
+# el endpoint OAuth no son idempotentes (un 500 puede llegar con el trabajo ya hecho o el
+# refresh_token ya rotado), así que ahí solo se reintenta si la petición no se procesó.
+RETRY_TOTAL = 5
+RETRY_BACKOFF_FACTOR = 0.5
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+RETRY_STATUSES_NON_IDEMPOTENT = frozenset({429, 503})
+RETRY_MAX_DELAY = 120
+
+class RetryTransport(httpx.AsyncBaseTransport):
+    """
+    Transport que reintenta GET/POST cuando la respuesta tiene un status reintentable:
+    RETRY_STATUSES para la API de datos de TikTok, RETRY_STATUSES_NON_IDEMPOTENT para el resto.
+    Espera lo que indique Retry-After (segundos o fecha HTTP) o, si no viene, backoff exponencial.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self._transport = transport
+
+    @staticmethod
+    def _retry_statuses(request: httpx.Request) -> frozenset:
+        url = request.url
+        if url.host == TIKTOK_HOST and not url.path.startswith(TIKTOK_OAUTH_PATH):
+            return RETRY_STATUSES
+        return RETRY_STATUSES_NON_IDEMPOTENT
+
+    @staticmethod
+    def _retry_after(response: httpx.Response) -> Optional[float]:
+        value = response.headers.get("Retry-After")
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        retry_statuses = self._retry_statuses(request)
+        attempt = 0
+        while True:
+            response = await self._transport.handle_async_request(request)
+            if (
+                response.status_code not in retry_statuses
+                or request.method not in ("GET", "POST")
+                or attempt >= RETRY_TOTAL
+            ):
+                return response
+
+            delay = self._retry_after(response)
+            if delay is None:
+                delay = RETRY_BACKOFF_FACTOR * (2 ** attempt)
+            delay = min(delay, RETRY_MAX_DELAY)
+            await response.aclose()
+            attempt += 1
+            logger.warning("retry %s %s status=%d attempt=%d delay=%.1fs",
+                           request.method, request.url.path, response.status_code, attempt, delay)
+            await asyncio.sleep(delay)
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global ASYNC_CLIENT
+    ASYNC_CLIENT = httpx.AsyncClient(
+        transport=RetryTransport(
+            httpx.AsyncHTTPTransport(
+                http2=True,
+                limits=httpx.Limits(max_keepalive_connections=20),
+                retries=3,  # reintentos de conexión
+            )
+        ),
+        timeout=30,
+        # httpx descomprime br de forma transparente si está instalado el paquete brotli
+        headers={"User-Agent": "DescubreTuCasa/1.0", "Accept-Encoding": "gzip, br"},
+    )
+    try:
+        yield
+    finally:
+        await ASYNC_CLIENT.aclose()
+        ASYNC_CLIENT = None
+
+app = FastAPI(lifespan=lifespan)
+
+# ========= Caché de tokens en memoria =========
+# Espejo en proceso de la fila de Supabase para no consultar la BD en cada petición.
+# TOKEN_CACHE_TTL fuerza una relectura periódica por si la fila cambia desde fuera.
+# Solo se refresca cuando al token le quedan menos de TOKEN_REFRESH_MARGIN segundos, y
+# _REFRESH_LOCK garantiza un único refresh en vuelo aunque lleguen peticiones concurrentes.
+TOKEN_CACHE_TTL = 300
+TOKEN_REFRESH_MARGIN = 300
+# Si TikTok rechaza el refresh (4xx salvo 429), no se reintenta hasta pasado este tiempo.
+REFRESH_FAILURE_COOLDOWN = 600
+_TOKEN_CACHE: Dict[str, Any] = {}
+_TOKEN_LOCK = threading.Lock()
+_REFRESH_LOCK = asyncio.Lock()
+
+def _cache_tokens(fields: Dict[str, Any]) -> None:
+    """Vuelca en la caché los campos de token recibidos (solo los no nulos)."""
+    with _TOKEN_LOCK:
+        for key in ("access_token", "refresh_token", "expires_at"):
+            if fields.get(key) is not None:
+                _TOKEN_CACHE[key] = fields[key]
+        _TOKEN_CACHE["loaded_at"] = time.time()
+
+def _cached_access_token() -> Optional[str]:
+    """Devuelve el access_token cacheado si sigue vigente y la caché no ha vencido."""
+    now = time.time()
+    with _TOKEN_LOCK:
+        access_token = _TOKEN_CACHE.get("access_token")
+        expires_at = int(_TOKEN_CACHE.get("expires_at") or 0)
+        loaded_at = _TOKEN_CACHE.get("loaded_at", 0)
+    if not access_token or now - loaded_at > TOKEN_CACHE_TTL:
+        return None
+    if expires_at - now < TOKEN_REFRESH_MARGIN:
+        return None
+    return access_token
+
+def _cached_token_field(key: str) -> Any:
+    """Lee un campo de la caché de tokens bajo _TOKEN_LOCK."""
+    with _TOKEN_LOCK:
+        return _TOKEN_CACHE.get(key)
+
+def _check_refresh_cooldown() -> None:
+    """Falla rápido con 401 si el último refresh fue rechazado hace menos de REFRESH_FAILURE_COOLDOWN."""
+    with _TOKEN_LOCK:
+        failed_until = _TOKEN_CACHE.get("refresh_failed_until", 0)
+    if time.time() < failed_until:
+        raise HTTPException(
+            status_code=401,
+            detail={"oauth_refresh_error": "refresh rechazado recientemente; reautoriza la app",
+                    "retry_after": int(failed_until - time.time())},
+        )
 
 # ========= Acceso a tokens en Supabase =========
 def get_tokens_row() -> Optional[Dict[str, Any]]:
     """
     Lee (si existe) la fila de tokens del provider 'tiktok'.
+    Solo trae las columnas que se usan en la lectura.
     """
-    res = supabase.table("tokens") \
-        .select("provider, account_open_id, access_token, refresh_token, scope, expires_at, updated_at") \
+    res = get_supabase().table("tokens") \
+        .select("access_token, refresh_token, expires_at") \
         .eq("provider", "tiktok") \
-        .limit(1) \
+        .maybe_single() \
         .execute()
-    rows = res.data or []
-    return rows[0] if rows else None
+    # maybe_single() devuelve None (no una respuesta vacía) si no hay fila
+    return res.data if res else None
+
+async def _current_refresh_token() -> Optional[str]:
+    """
+    refresh_token de la caché si se cargó hace menos de TOKEN_CACHE_TTL; si no, relee la fila
+    de Supabase por si se ha rotado desde fuera (otra instancia, un arreglo manual...).
+    Así no se manda a TikTok un refresh_token ya gastado que dispararía el cool-down.
+    """
+    with _TOKEN_LOCK:
+        refresh_token = _TOKEN_CACHE.get("refresh_token")
+        loaded_at = _TOKEN_CACHE.get("loaded_at", 0)
+    if refresh_token and time.time() - loaded_at <= TOKEN_CACHE_TTL:
+        return refresh_token
+
+    row = await run_in_threadpool(get_tokens_row)
+    if not row:
+        return refresh_token
+    _cache_tokens(row)
+    return row.get("refresh_token")
 
 def upsert_tokens(
     access_token: Optional[str] = None,
@@ -59,6 +261,8 @@ def upsert_tokens(
     Inserta/actualiza tokens en la fila provider='tiktok'.
     expires_in: segundos desde ahora (si viene de TikTok).
     """
+    now_ts = time.time()
+    now_dt = datetime.fromtimestamp(now_ts, timezone.utc)
     payload: Dict[str, Any] = {"provider": "tiktok"}
 
     if access_token is not None:
@@ -69,43 +273,62 @@ def upsert_tokens(
         payload["scope"] = scope
 
     if expires_in is not None:
-        expires_at = int(time.time()) + int(expires_in) - 60  # margen de 60s
+        expires_at = int(now_ts) + int(expires_in) - 60  # margen de 60s
         payload["expires_at"] = expires_at
 
     if account_open_id is not None:
         payload["account_open_id"] = account_open_id
 
-    payload["updated_at"] = datetime.now(timezone.utc).isoformat()
+    payload["updated_at"] = now_dt.isoformat()
 
-    supabase.table("tokens").upsert(payload, on_conflict="provider").execute()
+    get_supabase().table("tokens").upsert(payload, on_conflict="provider").execute()
+    if access_token is not None or refresh_token is not None or expires_in is not None:
+        _cache_tokens(payload)
+    if access_token is not None:
+        with _TOKEN_LOCK:
+            _TOKEN_CACHE.pop("refresh_failed_until", None)
 
-def get_valid_access_token() -> str:
+async def get_valid_access_token() -> str:
     """
     Devuelve un access_token válido. Si está caducado o no existe, intenta refrescar.
+    Usa la caché en memoria siempre que puede; solo va a Supabase en caso de fallo.
     """
-    row = get_tokens_row()
-    if not row:
-        raise RuntimeError("No hay tokens guardados en Supabase (provider='tiktok'). Realiza primero el intercambio de authorization_code.")
+    cached = _cached_access_token()
+    if cached:
+        return cached
+
+    async with _REFRESH_LOCK:
+        # Otra petición puede haber refrescado mientras esperábamos el lock
+        cached = _cached_access_token()
+        if cached:
+            return cached
 
-    now = int(time.time())
-    access_token = row.get("access_token")
-    expires_at = row.get("expires_at") or 0
+        row = await run_in_threadpool(get_tokens_row)
+        if not row:
+            raise RuntimeError("No hay tokens guardados en Supabase (provider='tiktok'). Realiza primero el intercambio de authorization_code.")
+        _cache_tokens(row)
 
-    if access_token and now < int(expires_at):
-        return access_token
+        now = int(time.time())
+        access_token = row.get("access_token")
+        expires_at = row.get("expires_at") or 0
 
-    # Necesitamos refrescar
-    refresh_token = row.get("refresh_token")
-    if not refresh_token:
-        raise RuntimeError("No hay refresh_token guardado. Reautoriza la app.")
+        if access_token and int(expires_at) - now >= TOKEN_REFRESH_MARGIN:
+            return access_token
 
-    return refresh_access_token(refresh_token)
+        # Necesitamos refrescar
+        refresh_token = row.get("refresh_token")
+        if not refresh_token:
+            raise RuntimeError("No hay refresh_token guardado. Reautoriza la app.")
 
-def refresh_access_token(refresh_token: str) -> str:
+        return await refresh_access_token(refresh_token)
+
+async def refresh_access_token(refresh_token: str) -> str:
     """
     Pide un nuevo access_token usando refresh_token y guarda los nuevos datos en Supabase.
+    Si TikTok lo rechaza (4xx salvo 429) se bloquean nuevos intentos durante REFRESH_FAILURE_COOLDOWN.
     """
-    resp = requests.post(
+    _check_refresh_cooldown()
+    resp = await ASYNC_CLIENT.post(
         f"{BASE}/oauth/token/",
         data={
             "client_key": CLIENT_KEY,
@@ -120,6 +343,10 @@ def refresh_access_token(refresh_token: str) -> str:
             body = resp.json()
         except Exception:
             body = {"text": resp.text}
+        # 429 es rate limiting, no un refresh_token revocado: no bloqueamos por ello
+        if resp.status_code < 500 and resp.status_code != 429:
+            with _TOKEN_LOCK:
+                _TOKEN_CACHE["refresh_failed_until"] = time.time() + REFRESH_FAILURE_COOLDOWN
         raise HTTPException(status_code=resp.status_code, detail={"oauth_refresh_error": body})
 
     data = resp.json()
@@ -129,7 +356,8 @@ def refresh_access_token(refresh_token: str) -> str:
     scope = data.get("scope")
     expires_in = int(data.get("expires_in", 3600))
 
-    upsert_tokens(
+    await run_in_threadpool(
+        upsert_tokens,
         access_token=access_token,
         refresh_token=new_refresh,
         scope=scope,
@@ -138,91 +366,333 @@ def refresh_access_token(refresh_token: str) -> str:
     return access_token
 
 # ========= Llamadas API TikTok =========
-def api_post(path: str, access_token: str, body: dict):
+API_HEADERS: Dict[str, str] = {"Accept": "application/json"}
+
+async def api_post(path: str, access_token: str, body: dict):
     """POST helper con logging de errores detallado."""
-    url = f"{BASE}{path}?fields={','.join(VIDEO_FIELDS)}"
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-    }
-    resp = requests.post(url, headers=headers, data=json.dumps(body))
+    url = f"{BASE}{path}?fields={VIDEO_FIELDS_CSV}"
+    headers = {**API_HEADERS, "Authorization": f"Bearer {access_token}"}
+    resp = await ASYNC_CLIENT.post(url, headers=headers, json=body)
     if resp.status_code >= 400:
         # Muestra el texto que devuelve TikTok para entender el 400
         try:
-            print("TikTok error body:", json.dumps(resp.json(), ensure_ascii=False, indent=2))
+            body = resp.json()
+            logger.warning("TikTok error status=%d body=%s", resp.status_code, json.dumps(body, ensure_ascii=False))
         except Exception:
-            print("TikTok error text:", resp.text)
-        resp.raise_for_status()
+            body = {"text": resp.text}
+            logger.warning("TikTok error status=%d text=%s", resp.status_code, resp.text)
+        raise HTTPException(status_code=resp.status_code, detail={"tiktok_api_error": body})
     return resp.json()
 
-def fetch_all_videos(max_count: int = 20) -> List[dict]:
+def _page_meta(data: Optional[dict]) -> Dict[str, Any]:
+    # Estructura esperada: { "data": { "videos": [...], "cursor": "...", "has_more": true/false } }
+    return (data or {}).get("data") or {}
+
+async def iter_video_pages(max_count: int = 20) -> AsyncIterator[List[dict]]:
     """
-    Pagina todos los videos del usuario autenticado (owner).
+    Recorre todos los videos del usuario autenticado (owner) y los va entregando página a página,
+    sin acumular la lista completa en memoria: como mucho VIDEO_LIST_PREFETCH_PAGES páginas por
+    tramo en vuelo esperan a que el consumidor llegue a ellas.
+    El cursor de /video/list/ es un timestamp UTC en ms ("vídeos anteriores a"), así que tras
+    VIDEO_LIST_SERIAL_PAGES páginas en serie se trocea el resto en tramos dimensionados según
+    la densidad de vídeos observada, que se recorren en paralelo en una ventana deslizante
+    (máx. VIDEO_LIST_CONCURRENCY tramos y peticiones a la vez) hasta cubrir todo el histórico.
+    Las páginas se entregan en orden (más recientes primero).
+    Si el cursor no es numérico se pagina en serie como siempre.
+    Si TikTok responde 401 se refresca el token una sola vez por crawl y se reintenta la página.
     """
-    token = get_valid_access_token()
-    all_items: List[dict] = []
-    cursor: Optional[str] = None
-    page = 1
-
-    while True:
-        body = {
-            "max_count": max_count,
-            "fields": VIDEO_FIELDS,
-        }
+    token = await get_valid_access_token()
+    refreshed = False
+    pages = 0
+    sem = asyncio.Semaphore(VIDEO_LIST_CONCURRENCY)
+
+    async def list_page(cursor: Optional[int]) -> Dict[str, Any]:
+        nonlocal token, refreshed, pages
+        body = {**BASE_LIST_BODY}
+        if max_count != BASE_LIST_BODY["max_count"]:
+            body["max_count"] = max_count
         if cursor:
             body["cursor"] = cursor
 
-        print(f"[video.list] page={page} body={body}")
-        data = api_post("/video/list/", token, body)
-
-        # Estructura esperada: { "data": { "videos": [...], "cursor": "...", "has_more": true/false } }
-        videos = ((data or {}).get("data") or {}).get("videos") or []
-        all_items.extend(videos)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("video.list request body=%s", body)
+        used = token
+        try:
+            async with sem:
+                meta = _page_meta(await api_post("/video/list/", used, body))
+        except HTTPException as e:
+            if e.status_code != 401:
+                raise
+            async with _REFRESH_LOCK:
+                # Otro tramo (u otra petición) puede haber refrescado ya mientras esperábamos
+                if token == used:
+                    cached = _cached_access_token()
+                    if cached and cached != used:
+                        token = cached
+                    elif refreshed:
+                        raise
+                    else:
+                        refresh_token = await _current_refresh_token()
+                        if not refresh_token:
+                            raise
+                        refreshed = True
+                        token = await refresh_access_token(refresh_token)
+            async with sem:
+                meta = _page_meta(await api_post("/video/list/", token, body))
+
+        pages += 1
+        logger.debug(
+            "video.list page=%d got=%d has_more=%s cursor=%s",
+            pages, len(meta.get("videos") or []), meta.get("has_more", False), meta.get("cursor"),
+        )
+        return meta
+
+    async def crawl(
+        cursor: Optional[int], lower_ms: int = 0, stats: Optional[Dict[str, Any]] = None,
+    ) -> AsyncIterator[List[dict]]:
+        """
+        Pagina en serie desde `cursor` hasta agotar vídeos o bajar de `lower_ms`.
+        Solo entrega vídeos con lower_ms <= create_time < cursor inicial (si es numérico): los
+        tramos quedan disjuntos aunque TikTok incluya el propio cursor, sin guardar ids vistos.
+        En `stats` deja cuántos vídeos entregó, si no hay nada más antiguo ("end") y, si se
+        pasó de `lower_ms`, el timestamp del primer vídeo más antiguo ("older_ms").
+        """
+        stats = stats if stats is not None else {}
+        stats.update(count=0, end=False, older_ms=None, newest_ms=None, oldest_ms=None)
+        try:
+            upper_ms = int(cursor) if cursor is not None else None
+        except (TypeError, ValueError):
+            upper_ms = None
+        while True:
+            meta = await list_page(cursor)
+            videos = meta.get("videos") or []
+            in_range = []
+            for v in videos:
+                created_ms = int(v.get("create_time") or 0) * 1000
+                if created_ms < lower_ms:
+                    stats["older_ms"] = created_ms
+                    break
+                if upper_ms is None or created_ms < upper_ms:
+                    in_range.append(v)
+                    if stats["newest_ms"] is None:
+                        stats["newest_ms"] = created_ms
+                    stats["oldest_ms"] = created_ms
+            if in_range:
+                stats["count"] += len(in_range)
+                yield in_range
+
+            has_more = meta.get("has_more", False)
+            cursor = meta.get("cursor")
+            if stats["older_ms"] is not None:
+                return
+            if not has_more or not cursor:
+                stats["end"] = True
+                return
+
+    async def pump(queue: asyncio.Queue, hi: int, lo: int, stats: Dict[str, Any]) -> None:
+        try:
+            async for videos in crawl(hi, lo, stats):
+                await queue.put(videos)
+            await queue.put(None)
+        except Exception as e:
+            await queue.put(e)
+
+    # Primeras páginas en serie: las cuentas pequeñas acaban aquí y el resto estima densidad
+    cursor: Optional[Any] = None
+    newest_ms: Optional[int] = None
+    seen = 0
+    for _ in range(VIDEO_LIST_SERIAL_PAGES):
+        meta = await list_page(cursor)
+        videos = meta.get("videos") or []
+        if videos:
+            if newest_ms is None:
+                newest_ms = int(videos[0].get("create_time") or 0) * 1000
+            seen += len(videos)
+            yield videos
 
-        meta = (data or {}).get("data") or {}
-        has_more = meta.get("has_more", False)
         cursor = meta.get("cursor")
-        print(f"[video.list] got={len(videos)} has_more={has_more} next_cursor={cursor}")
-
-        if not has_more or not cursor:
-            break
+        if not meta.get("has_more") or not cursor:
+            return
 
-        page += 1
+    try:
+        upper = int(cursor)
+    except (TypeError, ValueError):
+        upper = None
+
+    if upper is None or newest_ms is None or newest_ms <= upper or upper <= VIDEO_LIST_EPOCH_MS:
+        async for videos in crawl(cursor):
+            yield videos
+        return
+
+    # Ventana deslizante: hasta VIDEO_LIST_CONCURRENCY tramos en vuelo, cada uno del tamaño
+    # esperado para VIDEO_LIST_PAGES_PER_SLICE páginas a la densidad del último tramo con
+    # vídeos (la media acumulada se diluye con los huecos sin publicar de las cuentas a ráfagas).
+    # Al terminar el tramo más reciente se lanza el siguiente, hasta cubrir todo el histórico.
+    # Se apunta algo por debajo de páginas completas: así la última página del tramo ya trae el
+    # primer vídeo más antiguo y no hace falta otra petición solo para ver que se ha acabado.
+    target = VIDEO_LIST_PAGES_PER_SLICE * max_count - max(max_count // 4, 1)
+    span = max((newest_ms - upper) * target // seen, 1)
+    next_hi = upper
+    exhausted = False  # ya no quedan vídeos por debajo de next_hi
+    window: Deque[Tuple[asyncio.Queue, asyncio.Task, Dict[str, Any]]] = deque()
+
+    def launch() -> None:
+        nonlocal next_hi, exhausted
+        lo = next_hi - span
+        if lo <= VIDEO_LIST_EPOCH_MS:
+            lo = 0  # último tramo: recoge cualquier vídeo anterior
+            exhausted = True
+        queue: asyncio.Queue = asyncio.Queue(maxsize=VIDEO_LIST_PREFETCH_PAGES)
+        stats: Dict[str, Any] = {"hi": next_hi, "lo": lo}
+        window.append((queue, asyncio.create_task(pump(queue, next_hi, lo, stats)), stats))
+        next_hi = lo
 
-    print(f"[video.list] total videos: {len(all_items)}")
-    return all_items
+    try:
+        while True:
+            while not exhausted and len(window) < VIDEO_LIST_CONCURRENCY:
+                launch()
+            if not window:
+                return
+
+            # Los tramos se vacían en orden para mantener el orden cronológico
+            queue, _, stats = window.popleft()
+            while (item := await queue.get()) is not None:
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+
+            if stats["end"]:
+                # Nada más antiguo: los tramos ya lanzados terminarán vacíos
+                exhausted = True
+            elif stats["older_ms"] is not None and stats["older_ms"] < next_hi:
+                # Hueco sin vídeos: saltamos directamente al siguiente vídeo conocido
+                next_hi = stats["older_ms"] + 1
+
+            if stats["count"] >= 2:
+                span = max((stats["newest_ms"] - stats["oldest_ms"]) * target // (stats["count"] - 1), 1)
+    finally:
+        for _, task, _ in window:
+            task.cancel()
 
 # ========= n8n =========
-def call_n8n() -> dict:
-    videos = fetch_all_videos(max_count=20)
-    resp = requests.post(
+async def post_n8n_page(items: List[dict], page: int, final: bool, error: Optional[str] = None) -> int:
+    """
+    Manda una página de vídeos a n8n. Devuelve el status HTTP.
+    `error` se incluye en el payload cuando el crawl se ha abortado antes de terminar.
+    """
+    payload: Dict[str, Any] = {"items": items, "page": page, "final": final}
+    if error is not None:
+        payload["error"] = error
+    # orjson serializa a bytes directamente, bastante más rápido que el json de stdlib;
+    # el cuerpo va comprimido con gzip (n8n lo descomprime según Content-Encoding)
+    resp = await ASYNC_CLIENT.post(
         N8N_URL,
-        json={"items": videos},
-        headers={"Content-Type": "application/json"},
+        content=gzip.compress(orjson.dumps(payload)),
+        headers={"Content-Type": "application/json", "Content-Encoding": "gzip"},
         timeout=60,
     )
-    return {"n8n_status": resp.status_code, "n8n_text": resp.text[:500], "count": len(videos)}
+    logger.debug("n8n page=%d final=%s count=%d status=%d", page, final, len(items), resp.status_code)
+    if resp.status_code >= 400:
+        logger.warning("n8n error page=%d status=%d text=%s", page, resp.status_code, resp.text[:500])
+    return resp.status_code
+
+async def call_n8n(max_count: int = 20) -> dict:
+    """
+    Recorre los vídeos y los manda a n8n página a página según llegan.
+    Se retiene una página para poder marcar la última con final=True.
+    Las páginas que n8n rechaza (o que no llegan) se apuntan en failed_pages y se sigue con
+    las demás. Si el crawl se aborta, la última página se manda igualmente con final=True y
+    el error, para que n8n sepa que la ejecución ha terminado.
+    Se ejecuta como BackgroundTask, así que el resultado solo se loguea.
+    """
+    page = 0
+    count = 0
+    failed_pages: List[int] = []
+    crawl_error: Optional[str] = None
+    pending: Optional[List[dict]] = None
+
+    async def deliver(items: List[dict], page_no: int, final: bool) -> Optional[int]:
+        try:
+            status = await post_n8n_page(items, page_no, final, error=crawl_error)
+        except Exception:
+            logger.exception("n8n delivery failed page=%d", page_no)
+            status = None
+        if status is None or status >= 400:
+            failed_pages.append(page_no)
+        return status
+
+    try:
+        async for videos in iter_video_pages(max_count=max_count):
+            if pending is not None:
+                await deliver(pending, page, final=False)
+            page += 1
+            count += len(videos)
+            pending = videos
+    except Exception as e:
+        crawl_error = str(e) or repr(e)
+        logger.exception("video.list crawl aborted after pages=%d count=%d", page, count)
+
+    status = await deliver(pending or [], max(page, 1), final=True)
+
+    result: Dict[str, Any] = {"n8n_status": status, "pages": page, "count": count, "failed_pages": failed_pages}
+    if crawl_error is not None:
+        result["crawl_error"] = crawl_error
+    if failed_pages:
+        logger.warning("n8n failed pages=%s of %d", failed_pages, max(page, 1))
+    logger.info("video.list done pages=%d total=%d n8n_status=%s failed=%d", page, count, status, len(failed_pages))
+    return result
+
+# Crawl en curso: las llamadas concurrentes a / se unen a él en vez de lanzar otro
+_inflight: Optional[asyncio.Task] = None
+_INFLIGHT_LOCK = asyncio.Lock()
+
+def crawl_in_progress() -> bool:
+    return _inflight is not None and not _inflight.done()
+
+def _clear_inflight(task: asyncio.Task) -> None:
+    global _inflight
+    if _inflight is task:
+        _inflight = None
+
+async def call_n8n_coalesced(max_count: int = 20) -> dict:
+    """
+    Lanza call_n8n o, si ya hay uno en marcha, espera a ese mismo resultado (y lo deja en el log).
+    """
+    global _inflight
+    async with _INFLIGHT_LOCK:
+        if crawl_in_progress():
+            logger.info("video.list crawl already running: joining it")
+        else:
+            _inflight = asyncio.create_task(call_n8n(max_count=max_count))
+            _inflight.add_done_callback(_clear_inflight)
+        task = _inflight
+    # shield: si se cancela a quien espera, el crawl compartido sigue adelante
+    return await asyncio.shield(task)
 
 # ========= Endpoints =========
 @app.get("/")
-def run_now():
+async def run_now(bg: BackgroundTasks):
     """
     Dispara el flujo: asegura token válido, obtiene todos los vídeos y los manda a n8n.
+    El crawl y el envío a n8n (página a página) se hacen en segundo plano tras responder.
+    Si ya hay un crawl en marcha no se lanza otro: la petición se une al existente.
     """
     try:
-        result = call_n8n()
-        return {"ok": True, **result}
+        # Comprobamos el token antes de responder para devolver los errores de auth al momento
+        await get_valid_access_token()
+        bg.add_task(call_n8n_coalesced, max_count=20)
+        return {"ok": True, "dispatched": True}
     except Exception as e:
         return {"ok": False, "error": str(e)}
 
 @app.get("/oauth/tiktok/callback")
-def oauth_callback(code: str = Query(...), state: Optional[str] = Query(None)):
+async def oauth_callback(code: str = Query(...), state: Optional[str] = Query(None)):
     """
     Intercambia el authorization_code por tokens y los guarda en Supabase.
     Luego obtiene el open_id con /user/info y lo guarda en la fila.
     """
     # 1) Intercambiar code -> tokens
-    token_resp = requests.post(
+    token_resp = await ASYNC_CLIENT.post(
         f"{BASE}/oauth/token/",
         data={
             "client_key": CLIENT_KEY,
@@ -248,7 +718,8 @@ def oauth_callback(code: str = Query(...), state: Optional[str] = Query(None)):
     expires_in = int(tok.get("expires_in", 3600))
 
     # 2) Guardar tokens
-    upsert_tokens(
+    await run_in_threadpool(
+        upsert_tokens,
         access_token=access_token,
         refresh_token=refresh_token,
         scope=scope,
@@ -257,7 +728,7 @@ def oauth_callback(code: str = Query(...), state: Optional[str] = Query(None)):
 
     # 3) Obtener open_id del usuario y guardarlo
     headers = {"Authorization": f"Bearer {access_token}"}
-    info = requests.get(
+    info = await ASYNC_CLIENT.get(
         f"{BASE}/user/info/?fields=open_id,display_name,avatar_url",
         headers=headers,
         timeout=30,
@@ -266,17 +737,23 @@ def oauth_callback(code: str = Query(...), state: Optional[str] = Query(None)):
         user = (info.json().get("data") or {}).get("user") or {}
         open_id = user.get("open_id")
         if open_id:
-            upsert_tokens(account_open_id=open_id)
+            await run_in_threadpool(upsert_tokens, account_open_id=open_id)
 
     return {"ok": True, "saved": True, "state": state}
 
 @app.get("/refresh")
-def force_refresh():
+async def force_refresh():
     """
     Fuerza un refresh con el refresh_token guardado.
+    El refresh_token se lee dentro del lock: si otro refresh lo ha rotado mientras
+    esperábamos, se usa el nuevo y no el ya gastado.
     """
-    row = get_tokens_row()
-    if not row or not row.get("refresh_token"):
-        raise HTTPException(status_code=400, detail="No hay refresh_token guardado.")
-    new_access = refresh_access_token(row["refresh_token"])
-    return {"ok": True, "access_token_prefix": new_access[:12], "expires_at": get_tokens_row().get("expires_at")}
+    async with _REFRESH_LOCK:
+        refresh_token = await _current_refresh_token()
+        if not refresh_token:
+            raise HTTPException(status_code=400, detail="No hay refresh_token guardado.")
+        new_access = await refresh_access_token(refresh_token)
+        # upsert_tokens ya ha dejado el nuevo expires_at en la caché: no hace falta releer Supabase.
+        # Se lee antes de soltar el lock para que corresponda a este mismo token.
+        expires_at = _cached_token_field("expires_at")
+    return {"ok": True, "access_token_prefix": new_access[:12], "expires_at": expires_at}
@@ -0,0 +1,97 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from typing import List
+
+import httpx
+import pytest
+
+import main
+
+VIDEO_LIST_URL = f"{main.BASE}/video/list/"
+OAUTH_URL = f"{main.BASE}/oauth/token/"
+
+
+@pytest.fixture
+def sleeps(monkeypatch) -> List[float]:
+    """Sustituye la espera entre reintentos y devuelve los retrasos pedidos."""
+    delays: List[float] = []
+
+    async def fake_sleep(delay: float) -> None:
+        delays.append(delay)
+
+    monkeypatch.setattr(main.asyncio, "sleep", fake_sleep)
+    return delays
+
+
+def post(url: str, responses: List[httpx.Response]):
+    """POSTea a `url` contra un transport que va devolviendo `responses` (la última se repite)."""
+    calls = []
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        calls.append(request)
+        return responses[min(len(calls), len(responses)) - 1]
+
+    async def run() -> httpx.Response:
+        transport = main.RetryTransport(httpx.MockTransport(handle))
+        async with httpx.AsyncClient(transport=transport) as client:
+            return await client.post(url, json={"a": 1})
+
+    return asyncio.run(run()), calls
+
+
+def test_retry_after_in_seconds(sleeps):
+    resp, calls = post(VIDEO_LIST_URL, [httpx.Response(429, headers={"Retry-After": "7"}), httpx.Response(200)])
+
+    assert resp.status_code == 200
+    assert len(calls) == 2
+    assert sleeps == [7.0]
+    assert calls[1].content == calls[0].content
+
+
+def test_retry_after_as_http_date(sleeps):
+    when = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+    resp, calls = post(VIDEO_LIST_URL, [httpx.Response(503, headers={"Retry-After": when}), httpx.Response(200)])
+
+    assert resp.status_code == 200
+    assert len(sleeps) == 1 and 28 <= sleeps[0] <= 30
+
+
+def test_retry_after_is_capped(sleeps):
+    resp, _ = post(VIDEO_LIST_URL, [httpx.Response(429, headers={"Retry-After": "3600"}), httpx.Response(200)])
+
+    assert resp.status_code == 200
+    assert sleeps == [main.RETRY_MAX_DELAY]
+
+
+def test_gives_up_after_retry_total(sleeps):
+    resp, calls = post(VIDEO_LIST_URL, [httpx.Response(502)])
+
+    assert resp.status_code == 502
+    assert len(calls) == main.RETRY_TOTAL + 1
+    assert sleeps == [main.RETRY_BACKOFF_FACTOR * 2 ** i for i in range(main.RETRY_TOTAL)]
+
+
+def test_5xx_is_retried_on_video_list(sleeps):
+    resp, calls = post(VIDEO_LIST_URL, [httpx.Response(500), httpx.Response(200)])
+
+    assert resp.status_code == 200
+    assert len(calls) == 2
+
+
+@pytest.mark.parametrize("url", [OAUTH_URL, main.N8N_URL])
+def test_5xx_is_not_retried_on_non_idempotent_endpoints(sleeps, url):
+    resp, calls = post(url, [httpx.Response(500), httpx.Response(200)])
+
+    assert resp.status_code == 500
+    assert len(calls) == 1
+    assert sleeps == []
+
+
+@pytest.mark.parametrize("url", [OAUTH_URL, main.N8N_URL])
+@pytest.mark.parametrize("status", [429, 503])
+def test_unprocessed_responses_are_retried_everywhere(sleeps, url, status):
+    resp, calls = post(url, [httpx.Response(status), httpx.Response(200)])
+
+    assert resp.status_code == 200
+    assert len(calls) == 2
@@ -0,0 +1,67 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def clean_token_cache(monkeypatch):
+    monkeypatch.setattr(main, "_TOKEN_CACHE", {})
+    # Sin Supabase: upsert_tokens solo actualiza la caché
+    monkeypatch.setattr(main, "get_supabase", lambda: pytest.fail("Supabase no debería usarse"))
+    monkeypatch.setattr(main, "upsert_tokens", fake_upsert)
+
+
+def fake_upsert(access_token=None, refresh_token=None, scope=None, expires_in=None, account_open_id=None):
+    fields = {"access_token": access_token, "refresh_token": refresh_token}
+    if expires_in is not None:
+        fields["expires_at"] = int(time.time()) + int(expires_in) - 60
+    main._cache_tokens(fields)
+
+
+def oauth(sent):
+    def handle(request: httpx.Request) -> httpx.Response:
+        form = dict(httpx.QueryParams(request.content.decode()))
+        sent.append(form["refresh_token"])
+        if form["refresh_token"] != "rt-rotated":
+            return httpx.Response(400, json={"error": "invalid_grant"})
+        return httpx.Response(200, json={"access_token": "at-new", "refresh_token": "rt-next", "expires_in": 86400})
+    return handle
+
+
+def run_force_refresh(sent):
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(oauth(sent))) as client:
+            main.ASYNC_CLIENT = client
+            try:
+                return await main.force_refresh()
+            finally:
+                main.ASYNC_CLIENT = None
+    return asyncio.run(run())
+
+
+def test_stale_cache_rereads_refresh_token_from_supabase(monkeypatch):
+    # La caché tiene un refresh_token ya rotado desde fuera y es más vieja que el TTL
+    main._cache_tokens({"access_token": "at-old", "refresh_token": "rt-spent", "expires_at": 0})
+    main._TOKEN_CACHE["loaded_at"] = time.time() - main.TOKEN_CACHE_TTL - 1
+    monkeypatch.setattr(main, "get_tokens_row", lambda: {"access_token": "at-old", "refresh_token": "rt-rotated", "expires_at": 0})
+    sent = []
+
+    result = run_force_refresh(sent)
+
+    assert sent == ["rt-rotated"]
+    assert result["access_token_prefix"] == "at-new"
+    assert "refresh_failed_until" not in main._TOKEN_CACHE
+
+
+def test_fresh_cache_does_not_hit_supabase(monkeypatch):
+    main._cache_tokens({"access_token": "at-old", "refresh_token": "rt-rotated", "expires_at": 0})
+    monkeypatch.setattr(main, "get_tokens_row", lambda: pytest.fail("no debería releer la fila"))
+    sent = []
+
+    run_force_refresh(sent)
+
+    assert sent == ["rt-rotated"]
@@ -0,0 +1,269 @@
+import asyncio
+import json
+import random
+import time
+from typing import List, Optional
+
+import httpx
+import pytest
+
+import main
+
+NEWEST = 1_760_000_000  # create_time (segundos) del vídeo más reciente
+
+
+def make_videos(n: int, step: int = 10, start: int = NEWEST) -> List[dict]:
+    """n vídeos, del más reciente al más antiguo, separados `step` segundos."""
+    return [{"id": str(i), "create_time": start - i * step} for i in range(n)]
+
+
+class FakeTikTok:
+    """
+    Simula /video/list/: devuelve vídeos anteriores al cursor (timestamp en ms).
+    opaque=True devuelve cursores no numéricos (índices opacos).
+    """
+
+    def __init__(self, videos: List[dict], opaque: bool = False):
+        self.videos = videos
+        self.opaque = opaque
+        self.calls: List[Optional[object]] = []
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        cursor = body.get("cursor")
+        self.calls.append(cursor)
+        max_count = body["max_count"]
+
+        if self.opaque:
+            start = int(cursor[1:]) if cursor else 0
+            page = self.videos[start:start + max_count]
+            end = start + len(page)
+            return httpx.Response(200, json={"data": {
+                "videos": page, "has_more": end < len(self.videos), "cursor": f"c{end}",
+            }})
+
+        if cursor is None:
+            candidates = self.videos
+        else:
+            candidates = [v for v in self.videos if v["create_time"] * 1000 < cursor]
+        page = candidates[:max_count]
+        next_cursor = page[-1]["create_time"] * 1000 if page else cursor
+        return httpx.Response(200, json={"data": {
+            "videos": page, "has_more": len(candidates) > len(page), "cursor": next_cursor,
+        }})
+
+
+def crawl(fake: FakeTikTok, monkeypatch, handler=None, access_token: str = "tok") -> List[List[dict]]:
+    async def token() -> str:
+        return access_token
+
+    async def run() -> List[List[dict]]:
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler or fake.handle)) as client:
+            monkeypatch.setattr(main, "ASYNC_CLIENT", client)
+            return [page async for page in main.iter_video_pages(max_count=20)]
+
+    monkeypatch.setattr(main, "get_valid_access_token", token)
+    return asyncio.run(run())
+
+
+def ids(pages: List[List[dict]]) -> List[str]:
+    return [v["id"] for page in pages for v in page]
+
+
+@pytest.mark.parametrize("step", [10, 600, 3600])
+def test_slices_are_complete_ordered_and_without_duplicates(monkeypatch, step):
+    videos = make_videos(500, step=step)
+    fake = FakeTikTok(videos)
+
+    pages = crawl(fake, monkeypatch)
+
+    assert ids(pages) == [v["id"] for v in videos]
+
+
+def test_bursty_account_with_gaps(monkeypatch):
+    # Ráfagas densas separadas por meses sin publicar: los tramos vacíos se saltan
+    rng = random.Random(7)
+    times = set()
+    start = NEWEST
+    for _ in range(6):
+        times.update(start - rng.randrange(0, 86400 * 3) for _ in range(80))
+        start -= 86400 * 120
+    videos = [{"id": str(i), "create_time": ts} for i, ts in enumerate(sorted(times, reverse=True))]
+    fake = FakeTikTok(videos)
+
+    pages = crawl(fake, monkeypatch)
+
+    assert ids(pages) == [v["id"] for v in videos]
+
+
+def test_same_timestamp_videos_at_slice_edges(monkeypatch):
+    # Parejas de vídeos con el mismo create_time repartidas por toda la cuenta
+    videos = [{"id": f"{i}-{j}", "create_time": NEWEST - i * 30} for i in range(150) for j in range(2)]
+    fake = FakeTikTok(videos)
+
+    pages = crawl(fake, monkeypatch)
+
+    assert ids(pages) == [v["id"] for v in videos]
+
+
+def test_slices_are_fetched_concurrently(monkeypatch):
+    latency = 0.02
+    videos = make_videos(2000, step=600)
+    fake = FakeTikTok(videos)
+    in_flight = {"now": 0, "peak": 0}
+
+    async def slow_handle(request: httpx.Request) -> httpx.Response:
+        in_flight["now"] += 1
+        in_flight["peak"] = max(in_flight["peak"], in_flight["now"])
+        await asyncio.sleep(latency)
+        in_flight["now"] -= 1
+        return fake.handle(request)
+
+    started = time.perf_counter()
+    pages = crawl(fake, monkeypatch, handler=slow_handle)
+    rtts = (time.perf_counter() - started) / latency
+
+    assert ids(pages) == [v["id"] for v in videos]
+    assert in_flight["peak"] == main.VIDEO_LIST_CONCURRENCY
+    # 100 páginas en serie serían ~100 RTTs
+    assert rtts < 100 / 2
+
+
+def test_non_numeric_cursor_falls_back_to_serial(monkeypatch):
+    videos = make_videos(130)
+    fake = FakeTikTok(videos, opaque=True)
+
+    pages = crawl(fake, monkeypatch)
+
+    assert ids(pages) == [v["id"] for v in videos]
+    assert fake.calls == [None] + [f"c{i}" for i in range(20, 130, 20)]
+
+
+def test_small_account_makes_no_extra_requests(monkeypatch):
+    videos = make_videos(45)
+    fake = FakeTikTok(videos)
+
+    pages = crawl(fake, monkeypatch)
+
+    assert ids(pages) == [v["id"] for v in videos]
+    assert len(fake.calls) == 3
+
+
+def test_recent_account_does_not_pay_for_empty_years(monkeypatch):
+    # 200 vídeos recientes (uno por hora): los tramos salen del ritmo observado, no de 2016→hoy
+    videos = make_videos(200, step=3600)
+    fake = FakeTikTok(videos)
+
+    pages = crawl(fake, monkeypatch)
+
+    assert ids(pages) == [v["id"] for v in videos]
+    assert len(fake.calls) <= 200 // 20 + main.VIDEO_LIST_CONCURRENCY
+
+
+def test_slices_prefetch_while_the_consumer_is_busy(monkeypatch):
+    # Mientras el consumidor está ocupado (p. ej. mandando una página a n8n), cada tramo de la
+    # ventana sigue adelantando páginas hasta su presupuesto en vez de quedarse a la espera.
+    videos = make_videos(2000, step=600)
+    fake = FakeTikTok(videos)
+
+    async def token() -> str:
+        return "tok"
+
+    async def run() -> int:
+        async with httpx.AsyncClient(transport=httpx.MockTransport(fake.handle)) as client:
+            monkeypatch.setattr(main, "ASYNC_CLIENT", client)
+            pages = main.iter_video_pages(max_count=20)
+            for _ in range(main.VIDEO_LIST_SERIAL_PAGES + 1):
+                await pages.__anext__()
+            await asyncio.sleep(0.1)
+            calls = len(fake.calls)
+            await pages.aclose()
+            return calls
+
+    monkeypatch.setattr(main, "get_valid_access_token", token)
+    calls = asyncio.run(run())
+
+    prefetched = calls - main.VIDEO_LIST_SERIAL_PAGES
+    assert prefetched >= main.VIDEO_LIST_CONCURRENCY * main.VIDEO_LIST_PAGES_PER_SLICE
+    assert prefetched <= main.VIDEO_LIST_CONCURRENCY * (main.VIDEO_LIST_PREFETCH_PAGES + 1)
+
+
+class ExpiringToken:
+    """
+    Envuelve FakeTikTok: responde 401 a "tok-old" a partir de la petición `expire_after`
+    (y a "tok-new" también, tras su primera petición, si still_401=True). refresh() cuenta los
+    refresh y tarda un poco para que los tramos concurrentes se solapen con él.
+    """
+
+    def __init__(self, fake: FakeTikTok, expire_after: int, still_401: bool = False):
+        self.fake = fake
+        self.expire_after = expire_after
+        self.still_401 = still_401
+        self.requests = 0
+        self.new_token_requests = 0
+        self.refreshes = 0
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        await asyncio.sleep(0.005)
+        token = request.headers["Authorization"].removeprefix("Bearer ")
+        if token == "tok-new":
+            self.new_token_requests += 1
+        expired = token == "tok-old" and self.requests > self.expire_after
+        if expired or (token == "tok-new" and self.still_401 and self.new_token_requests > 1):
+            return httpx.Response(401, json={"error": {"code": "access_token_invalid"}})
+        return self.fake.handle(request)
+
+    async def refresh(self, refresh_token: str) -> str:
+        assert refresh_token == "rt"
+        self.refreshes += 1
+        await asyncio.sleep(0.02)
+        return "tok-new"
+
+
+def crawl_with_expiry(tiktok: ExpiringToken, monkeypatch) -> List[List[dict]]:
+    monkeypatch.setattr(main, "_TOKEN_CACHE", {})
+    monkeypatch.setattr(main, "get_tokens_row", lambda: {"access_token": "tok-old", "refresh_token": "rt", "expires_at": 0})
+    monkeypatch.setattr(main, "refresh_access_token", tiktok.refresh)
+    return crawl(tiktok.fake, monkeypatch, handler=tiktok.handle, access_token="tok-old")
+
+
+def test_401_refreshes_once_and_retries_the_page(monkeypatch):
+    videos = make_videos(45)
+    tiktok = ExpiringToken(FakeTikTok(videos), expire_after=0)
+
+    pages = crawl_with_expiry(tiktok, monkeypatch)
+
+    assert ids(pages) == [v["id"] for v in videos]
+    assert tiktok.refreshes == 1
+    # La primera página se ha pedido dos veces: con el token caducado y con el nuevo
+    assert tiktok.fake.calls[0] is None and len(tiktok.fake.calls) == 3
+
+
+def test_concurrent_slices_hitting_401_share_one_refresh(monkeypatch):
+    videos = make_videos(2000, step=600)
+    # El token caduca justo cuando arranca la ventana de tramos
+    tiktok = ExpiringToken(FakeTikTok(videos), expire_after=main.VIDEO_LIST_SERIAL_PAGES)
+
+    pages = crawl_with_expiry(tiktok, monkeypatch)
+
+    assert ids(pages) == [v["id"] for v in videos]
+    assert tiktok.refreshes == 1
+    # Varios tramos han recibido 401 a la vez (si no, no probaría nada)
+    assert tiktok.requests - len(tiktok.fake.calls) > 1
+
+
+def test_second_401_after_refresh_is_raised(monkeypatch):
+    # El token nuevo sirve para reintentar la primera página y vuelve a dar 401 en la segunda:
+    # no se refresca otra vez en el mismo crawl
+    videos = make_videos(45)
+    tiktok = ExpiringToken(FakeTikTok(videos), expire_after=0, still_401=True)
+
+    with pytest.raises(main.HTTPException) as exc:
+        crawl_with_expiry(tiktok, monkeypatch)
+
+    assert exc.value.status_code == 401
+    assert tiktok.refreshes == 1
+    # Página 1 (401), página 1 reintentada con el token nuevo, página 2 (401) y nada más
+    assert tiktok.fake.calls == [None]
+    assert tiktok.requests == 3